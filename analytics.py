@@ -1,5 +1,5 @@
 from sqlalchemy import (
-    Column, Integer, String, Date, DateTime, Numeric, Boolean, ForeignKey, Index
+    Column, Integer, String, Date, DateTime, Numeric, Float, Boolean, ForeignKey, Index
 )
 from sqlalchemy.orm import declarative_base
 
@@ -7,7 +7,7 @@ BaseAnalytics = declarative_base()
 
 class DimDate(BaseAnalytics):
     __tablename__ = "dim_date"
-    date_key = Column(Integer, primary_key=True)
+    date_key = Column(Integer, primary_key=True, autoincrement=False)
     date = Column(Date)
     year = Column(Integer)
     quarter = Column(Integer)
@@ -18,7 +18,7 @@ class DimDate(BaseAnalytics):
 
 class DimFilm(BaseAnalytics):
     __tablename__ = "dim_film"
-    film_key = Column(Integer, primary_key=True)
+    film_key = Column(Integer, primary_key=True, autoincrement=False)
     film_id = Column(Integer, unique=True, index=True)
     title = Column(String)
     rating = Column(String(10))
@@ -26,10 +26,11 @@ class DimFilm(BaseAnalytics):
     language = Column(String(50))
     release_year = Column(Integer)
     last_update = Column(DateTime)
+    is_inferred = Column(Boolean, default=False)
 
 class DimActor(BaseAnalytics):
     __tablename__ = "dim_actor"
-    actor_key = Column(Integer, primary_key=True)
+    actor_key = Column(Integer, primary_key=True, autoincrement=False)
     actor_id = Column(Integer, unique=True, index=True)
     first_name = Column(String)
     last_name = Column(String)
@@ -37,22 +38,23 @@ class DimActor(BaseAnalytics):
 
 class DimCategory(BaseAnalytics):
     __tablename__ = "dim_category"
-    category_key = Column(Integer, primary_key=True)
+    category_key = Column(Integer, primary_key=True, autoincrement=False)
     category_id = Column(Integer, unique=True, index=True)
     name = Column(String)
     last_update = Column(DateTime)
 
 class DimStore(BaseAnalytics):
     __tablename__ = "dim_store"
-    store_key = Column(Integer, primary_key=True)
+    store_key = Column(Integer, primary_key=True, autoincrement=False)
     store_id = Column(Integer, unique=True, index=True)
     city = Column(String)
     country = Column(String)
     last_update = Column(DateTime)
+    is_inferred = Column(Boolean, default=False)
 
 class DimCustomer(BaseAnalytics):
     __tablename__ = "dim_customer"
-    customer_key = Column(Integer, primary_key=True)
+    customer_key = Column(Integer, primary_key=True, autoincrement=False)
     customer_id = Column(Integer, unique=True, index=True)
     first_name = Column(String)
     last_name = Column(String)
@@ -60,6 +62,7 @@ class DimCustomer(BaseAnalytics):
     city = Column(String)
     country = Column(String)
     last_update = Column(DateTime)
+    is_inferred = Column(Boolean, default=False)
 
 class BridgeFilmActor(BaseAnalytics):
     __tablename__ = "bridge_film_actor"
@@ -73,7 +76,7 @@ class BridgeFilmCategory(BaseAnalytics):
 
 class FactRental(BaseAnalytics):
     __tablename__ = "fact_rental"
-    fact_rental_key = Column(Integer, primary_key=True)
+    fact_rental_key = Column(Integer, primary_key=True, autoincrement=False)
     rental_id = Column(Integer, unique=True, index=True)
     date_key_rented = Column(Integer, ForeignKey("dim_date.date_key"))
     date_key_returned = Column(Integer, ForeignKey("dim_date.date_key"))
@@ -85,7 +88,7 @@ class FactRental(BaseAnalytics):
 
 class FactPayment(BaseAnalytics):
     __tablename__ = "fact_payment"
-    fact_payment_key = Column(Integer, primary_key=True)
+    fact_payment_key = Column(Integer, primary_key=True, autoincrement=False)
     payment_id = Column(Integer, unique=True, index=True)
     date_key_paid = Column(Integer, ForeignKey("dim_date.date_key"))
     customer_key = Column(Integer, ForeignKey("dim_customer.customer_key"))
@@ -98,5 +101,28 @@ class SyncState(BaseAnalytics):
     table_name = Column(String, primary_key=True)
     last_synced = Column(DateTime)
 
+class SyncRunHistory(BaseAnalytics):
+    __tablename__ = "sync_run_history"
+    run_started = Column(DateTime, primary_key=True)
+    table_name = Column(String, primary_key=True)
+    mode = Column(String(20))
+    applied_at = Column(DateTime)
+    rows_applied = Column(Integer)
+    watermark = Column(DateTime)
+    lag_p50_seconds = Column(Float)
+    lag_p95_seconds = Column(Float)
+    lag_max_seconds = Column(Float)
+    backlog_rows = Column(Integer)
+
 Index("ix_fact_rental_store", FactRental.store_key)
-Index("ix_fact_payment_store", FactPayment.store_key)
\ No newline at end of file
+Index("ix_fact_payment_store", FactPayment.store_key)
+
+# DuckDB runs an UPDATE as a delete + insert, so a dimension row that a fact points at could never be
+# updated again if the foreign key was there. The keys are all derived from the source ids anyway, so
+# on DuckDB we just skip creating the foreign keys.
+def _not_duckdb(ddl, target, bind, **kw):
+    return kw["dialect"].name != "duckdb"
+
+for _table in BaseAnalytics.metadata.tables.values():
+    for _fk in _table.foreign_key_constraints:
+        _fk.ddl_if(callable_=_not_duckdb)
@@ -0,0 +1,98 @@
+"""
+Quick benchmark to compare the SQLite and DuckDB targets. It fills an in-memory SQLite
+source with fake Sakila-style rows, runs init + full-load against each target, and then
+times a couple of the group-by reports we actually run over fact_rental and fact_payment.
+
+python benchmark.py --rentals 50000
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+
+from models import BaseSource, Language, Film, Actor, Category, FilmActor, FilmCategory, Address, City, Country, Store, Customer, Inventory, Rental, Payment
+import sync
+
+REPORTS = {
+    "rentals per store per month": """
+        SELECT f.store_key, d.year, d.month, COUNT(*), AVG(f.rental_duration_days)
+        FROM fact_rental f JOIN dim_date d ON d.date_key = f.date_key_rented
+        GROUP BY f.store_key, d.year, d.month
+    """,
+    "revenue per customer country": """
+        SELECT c.country, COUNT(*), SUM(p.amount)
+        FROM fact_payment p JOIN dim_customer c ON c.customer_key = p.customer_key
+        GROUP BY c.country
+    """,
+}
+
+def make_source(rentals, films=1000, customers=600, stores=2):
+    engine = create_engine("sqlite://")
+    BaseSource.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    rnd = random.Random(42)
+    now = datetime(2025, 1, 1)
+    session.add(Language(language_id=1, name="English", last_update=now))
+    session.add_all([Country(country_id=i, country=f"Country {i}", last_update=now) for i in range(1, 21)])
+    session.add_all([City(city_id=i, city=f"City {i}", country_id=i % 20 + 1, last_update=now) for i in range(1, 101)])
+    session.add_all([Address(address_id=i, address=f"{i} Main St", city_id=i % 100 + 1, last_update=now) for i in range(1, customers + stores + 1)])
+    session.add_all([Store(store_id=i, manager_staff_id=i, address_id=customers + i, last_update=now) for i in range(1, stores + 1)])
+    session.add_all([Customer(customer_id=i, store_id=i % stores + 1, first_name=f"F{i}", last_name=f"L{i}", active=1,
+                              create_date=now, address_id=i, last_update=now) for i in range(1, customers + 1)])
+    session.add_all([Film(film_id=i, title=f"Film {i}", language_id=1, rating="PG", length=rnd.randint(60, 180),
+                          release_year=2006, last_update=now) for i in range(1, films + 1)])
+    session.add_all([Actor(actor_id=i, first_name=f"A{i}", last_name=f"B{i}", last_update=now) for i in range(1, 201)])
+    session.add_all([Category(category_id=i, name=f"Category {i}", last_update=now) for i in range(1, 17)])
+    session.add_all([FilmActor(film_id=i, actor_id=i % 200 + 1, last_update=now) for i in range(1, films + 1)])
+    session.add_all([FilmCategory(film_id=i, category_id=i % 16 + 1, last_update=now) for i in range(1, films + 1)])
+    session.add_all([Inventory(inventory_id=i, film_id=i % films + 1, store_id=i % stores + 1, last_update=now) for i in range(1, films * 4 + 1)])
+    for i in range(1, rentals + 1):
+        rented = now - timedelta(days=rnd.randint(0, 700), minutes=rnd.randint(0, 1440))
+        session.add(Rental(rental_id=i, rental_date=rented, inventory_id=rnd.randint(1, films * 4), customer_id=rnd.randint(1, customers),
+                           return_date=rented + timedelta(days=rnd.randint(1, 10)), staff_id=1, last_update=now))
+        session.add(Payment(payment_id=i, customer_id=rnd.randint(1, customers), staff_id=1, rental_id=i,
+                            amount=Decimal(rnd.randint(99, 999)) / 100, payment_date=rented, last_update=now))
+    session.commit()
+    return session
+
+def run(target_url, source_session, repeat):
+    _, target_engine, _, TargetSession = sync.make_sessions("sqlite://", target_url)
+    sync.init(target_engine)
+    target_session = TargetSession()
+    start = time.perf_counter()
+    sync.full_load(source_session, target_session)
+    timings = {"full-load": time.perf_counter() - start}
+    with target_engine.connect() as conn:
+        for name, sql in REPORTS.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                conn.execute(text(sql)).all()
+            timings[name] = (time.perf_counter() - start) / repeat
+    target_session.close()
+    target_engine.dispose()
+    return timings
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rentals", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    sync.logger.setLevel("WARNING")
+    source_session = make_source(args.rentals)
+    with tempfile.TemporaryDirectory() as tmp:
+        results = {
+            "sqlite": run(f"sqlite:///{os.path.join(tmp, 'analytics.db')}", source_session, args.repeat),
+            "duckdb": run(f"duckdb:///{os.path.join(tmp, 'analytics.duckdb')}", source_session, args.repeat),
+        }
+    print(f"{'step':<32}{'sqlite (s)':>12}{'duckdb (s)':>12}")
+    for step in results["sqlite"]:
+        print(f"{step:<32}{results['sqlite'][step]:>12.3f}{results['duckdb'][step]:>12.3f}")
@@ -10,11 +10,14 @@ from dateutil import parser as dateparser
 from sqlalchemy import select, func
 
 from models import Language, Inventory, Address, City, Country
-from analytics import DimDate, DimFilm, DimActor, DimCategory, DimStore, DimCustomer, BridgeFilmActor, BridgeFilmCategory, FactRental, FactPayment
+from analytics import DimDate, DimFilm, DimActor, DimCategory, DimStore, DimCustomer, BridgeFilmActor, BridgeFilmCategory, FactRental, FactPayment, SyncRunHistory
 
 def get_key_from_id(id: int, multiplier=100) -> int:
     return id * multiplier + 1 if id is not None else None
 
+def get_id_from_key(key: int, multiplier=100) -> int:
+    return (key - 1) // multiplier if key is not None else None
+
 def get_last_update(source_session, table_name):
     # ok so I wasn't sure exactly how to do this at first and I asked ChatGPT about it, but
     # I knew the last_update column would store whatever time of the prior update was, but I wasn't sure
@@ -24,6 +27,41 @@ def get_last_update(source_session, table_name):
     # value, and the or datetime makes sure that there is a fallback value in case it is None for some reason.
     return source_session.scalar(select(func.max(table_name.last_update))) or datetime(1970,1,1)
 
+def is_columnar(session):
+    # DuckDB is a column store, so it wants big batches instead of one merge per row,
+    # this is what picks the bulk path in bulk_upsert and incremental
+    return session.get_bind().dialect.name == "duckdb"
+
+def bulk_upsert(session, model, rows):
+    """
+    Writes a whole batch of row dicts into one analytics table. On SQLite this is just
+    the normal merge for every row, but on DuckDB we hand the batch over as an Arrow
+    table and let DuckDB scan it in one INSERT ... ON CONFLICT, which is way faster than
+    going through the ORM one object at a time.
+    """
+    if not rows:
+        return
+    if not is_columnar(session):
+        for r in rows:
+            upsert(session, model(**r))
+        return
+    import pyarrow as pa
+
+    cols = [c.name for c in model.__table__.columns]
+    keys = [c.name for c in model.__table__.primary_key.columns]
+    updates = [c for c in cols if c not in keys]
+    on_conflict = (f"DO UPDATE SET {', '.join(f'{c} = excluded.{c}' for c in updates)}" if updates else "DO NOTHING")
+    batch = pa.Table.from_pylist(rows).select(cols)
+    con = session.connection().connection.driver_connection
+    con.register("bulk_batch", batch)
+    try:
+        con.execute(
+            f"INSERT INTO {model.__tablename__} ({', '.join(cols)}) SELECT {', '.join(cols)} FROM bulk_batch "
+            f"ON CONFLICT ({', '.join(keys)}) {on_conflict}"
+        )
+    finally:
+        con.unregister("bulk_batch")
+
 def upsert(session, obj):
     # https://stackoverflow.com/questions/1849567/can-sqlalchemys-session-merge-update-its-result-with-newer-data-from-the-data
     # make sure we avoid duplicates with merge, hence upsert; this all reminds me of Git
@@ -36,12 +74,12 @@ def date_key_from_datetime(dt):
         dt = dateparser.parse(dt)
     return int(dt.strftime("%Y%m%d"))
 
-def dim_date_from_date(d):
+def dim_date_row(d):
     if d is None:
         return None
     if isinstance(d, datetime):
         d = d.date()
-    return DimDate(
+    return dict(
         date_key=int(d.strftime("%Y%m%d")),
         date=d,
         year=d.year,
@@ -52,6 +90,19 @@ def dim_date_from_date(d):
         is_weekend=(d.weekday() >= 5)
     )
 
+def dim_date_rows(dates):
+    # keyed by date_key so the same day only shows up once in the batch
+    rows = {}
+    for d in dates:
+        if d:
+            row = dim_date_row(d)
+            rows[row["date_key"]] = row
+    return list(rows.values())
+
+def dim_date_from_date(d):
+    row = dim_date_row(d)
+    return DimDate(**row) if row else None
+
 def pct_diff(a, b):
         if a == 0 and b == 0:
             return 0.0
@@ -59,52 +110,52 @@ def pct_diff(a, b):
             return 100.0
         return abs((a - b) / max(a, 1)) * 100.0
 
-def upsert_dim_film(target_session, source_session, row):
-        upsert(target_session, DimFilm(
-                            film_key=get_key_from_id(row.film_id),
-                            film_id=row.film_id,
-                            title=row.title,
-                            rating=row.rating,
-                            length=row.length,
-                            language=(source_session.get(Language, row.language_id).name if row.language_id else None),
-                            release_year=row.release_year,
-                            last_update=row.last_update
-                        ))
+def dim_film_row(source_session, row):
+    return dict(
+        film_key=get_key_from_id(row.film_id),
+        film_id=row.film_id,
+        title=row.title,
+        rating=row.rating,
+        length=row.length,
+        language=(source_session.get(Language, row.language_id).name if row.language_id else None),
+        release_year=row.release_year,
+        last_update=row.last_update,
+        is_inferred=False
+    )
 
-def upsert_dim_actor(target_session, row):
-    upsert(target_session, DimActor(
-                            actor_key=get_key_from_id(row.actor_id),
-                            actor_id=row.actor_id,
-                            first_name=row.first_name,
-                            last_name=row.last_name,
-                            last_update=row.last_update
-                        ))
-        
-def upsert_dim_category(target_session, row):
-     upsert(target_session, DimCategory(
-                            category_key=get_key_from_id(row.category_id),
-                            category_id=row.category_id,
-                            name=row.name,
-                            last_update=row.last_update
-                        ))
+def dim_actor_row(row):
+    return dict(
+        actor_key=get_key_from_id(row.actor_id),
+        actor_id=row.actor_id,
+        first_name=row.first_name,
+        last_name=row.last_name,
+        last_update=row.last_update
+    )
 
-def upsert_film_actor(target_session, row):
-     upsert(target_session, BridgeFilmActor(
-                            film_key=get_key_from_id(row.film_id),
-                            actor_key=get_key_from_id(row.actor_id)
-                        ))
-     
-def upsert_film_category(target_session, row):
-     upsert(target_session, BridgeFilmCategory(
-                            film_key=get_key_from_id(row.film_id),
-                            category_key=get_key_from_id(row.category_id)
-                        ))
-     
-def upsert_rental(target_session, source_session, row):
+def dim_category_row(row):
+    return dict(
+        category_key=get_key_from_id(row.category_id),
+        category_id=row.category_id,
+        name=row.name,
+        last_update=row.last_update
+    )
+
+def film_actor_row(row):
+    return dict(
+        film_key=get_key_from_id(row.film_id),
+        actor_key=get_key_from_id(row.actor_id)
+    )
+
+def film_category_row(row):
+    return dict(
+        film_key=get_key_from_id(row.film_id),
+        category_key=get_key_from_id(row.category_id)
+    )
 
+def fact_rental_row(source_session, row):
     inv = source_session.get(Inventory, row.inventory_id) if row.inventory_id else None
     film_id = inv.film_id if inv else None
-    upsert(target_session, FactRental(
+    return dict(
         fact_rental_key=row.rental_id * 10 + 1,
         rental_id=row.rental_id,
         date_key_rented=date_key_from_datetime(row.rental_date),
@@ -114,30 +165,23 @@ def upsert_rental(target_session, source_session, row):
         customer_key=get_key_from_id(row.customer_id),
         staff_id=row.staff_id,
         rental_duration_days=((row.return_date - row.rental_date).days if row.return_date and row.rental_date else None)
-    ))
-    if row.rental_date:
-        upsert(target_session, dim_date_from_date(row.rental_date))
-    if row.return_date:
-        upsert(target_session, dim_date_from_date(row.return_date))
-
-def upsert_payment(target_session, row):
-    upsert(target_session, FactPayment(
-                            fact_payment_key=row.payment_id * 10 + 1,
-                            payment_id=row.payment_id,
-                            date_key_paid=date_key_from_datetime(row.payment_date),
-                            customer_key=get_key_from_id(row.customer_id),
-                            store_key=None,
-                            staff_id=row.staff_id,
-                            amount=row.amount
-                        ))
-    if row.payment_date:
-        upsert(target_session, dim_date_from_date(row.payment_date))
+    )
 
-def upsert_customer(target_session, source_session, row):
+def fact_payment_row(row):
+    return dict(
+        fact_payment_key=row.payment_id * 10 + 1,
+        payment_id=row.payment_id,
+        date_key_paid=date_key_from_datetime(row.payment_date),
+        customer_key=get_key_from_id(row.customer_id),
+        store_key=None,
+        staff_id=row.staff_id,
+        amount=row.amount
+    )
 
+def city_country(source_session, address_id):
     city = country = None
-    if row.address_id:
-        adr = source_session.get(Address, row.address_id)
+    if address_id:
+        adr = source_session.get(Address, address_id)
         if adr and adr.city_id:
             city_obj = source_session.get(City, adr.city_id)
             if city_obj:
@@ -146,7 +190,11 @@ def upsert_customer(target_session, source_session, row):
                     cobj = source_session.get(Country, city_obj.country_id)
                     if cobj:
                         country = cobj.country
-    upsert(target_session, DimCustomer(
+    return city, country
+
+def dim_customer_row(source_session, row):
+    city, country = city_country(source_session, row.address_id)
+    return dict(
         customer_key=get_key_from_id(row.customer_id),
         customer_id=row.customer_id,
         first_name=row.first_name,
@@ -154,25 +202,136 @@ def upsert_customer(target_session, source_session, row):
         active=row.active,
         city=city,
         country=country,
-        last_update=row.last_update
-    ))
+        last_update=row.last_update,
+        is_inferred=False
+    )
 
-def upsert_store(target_session, source_session, row):
-    city = country = None
-    if row.address_id:
-        adr = source_session.get(Address, row.address_id)
-        if adr and adr.city_id:
-            city_obj = source_session.get(City, adr.city_id)
-            if city_obj:
-                city = city_obj.city
-                if city_obj.country_id:
-                    cobj = source_session.get(Country, city_obj.country_id)
-                    if cobj:
-                        country = cobj.country
-    upsert(target_session, DimStore(
+def dim_store_row(source_session, row):
+    city, country = city_country(source_session, row.address_id)
+    return dict(
         store_key=get_key_from_id(row.store_id),
         store_id=row.store_id,
         city=city,
         country=country,
-        last_update=row.last_update
-    ))
\ No newline at end of file
+        last_update=row.last_update,
+        is_inferred=False
+    )
+
+class DimKeyCache:
+    """
+    Keeps the keys that are already in dim_film, dim_customer and dim_store in memory, so
+    when we load facts we can tell which dimension rows are missing without asking the
+    target every time. It gets warmed once at the start of a run and then we add keys to
+    it as the dimensions load.
+    """
+    # fact column -> (dimension it points at, the source id column on that dimension)
+    FACT_KEYS = {
+        "film_key": (DimFilm, "film_id"),
+        "customer_key": (DimCustomer, "customer_id"),
+        "store_key": (DimStore, "store_id"),
+    }
+
+    def __init__(self, target_session):
+        self.target_session = target_session
+        self.warm()
+
+    def warm(self):
+        self.keys = {}
+        for model, _ in self.FACT_KEYS.values():
+            pk = model.__table__.primary_key.columns[0]
+            self.keys[model] = set(self.target_session.scalars(select(pk)).all())
+
+    def add(self, model, *keys):
+        self.keys[model].update(keys)
+
+    def missing(self, fact_rows):
+        missing = {}
+        for col, (model, _) in self.FACT_KEYS.items():
+            for r in fact_rows:
+                key = r.get(col)
+                if key is not None and key not in self.keys[model]:
+                    missing.setdefault(model, set()).add(key)
+        return missing
+
+def inferred_row(model, id_col, key):
+    # placeholder for a dimension row we haven't seen yet, everything is empty except the
+    # keys and is_inferred, and the real row overwrites it once it shows up
+    row = {c.name: None for c in model.__table__.columns}
+    row[model.__table__.primary_key.columns[0].name] = key
+    row[id_col] = get_id_from_key(key)
+    row["is_inferred"] = True
+    return row
+
+def add_inferred_members(target_session, dim_keys, fact_rows):
+    """
+    Late-arriving facts can point at a film, customer or store that isn't in the
+    warehouse yet. For those we insert inferred placeholder rows in one batch per
+    dimension before the facts go in. Returns how many placeholders were added.
+    """
+    id_cols = {model: id_col for model, id_col in DimKeyCache.FACT_KEYS.values()}
+    added = 0
+    for model, keys in dim_keys.missing(fact_rows).items():
+        bulk_upsert(target_session, model, [inferred_row(model, id_cols[model], k) for k in sorted(keys)])
+        dim_keys.add(model, *keys)
+        added += len(keys)
+    return added
+
+def percentile(values, pct):
+    # nearest-rank percentile, good enough for a lag histogram and no numpy needed
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, -(-len(ordered) * pct // 100) - 1)]
+
+def sync_run_row(run_started, table_name, mode, applied_at, rows_applied, watermark, last_updates, backlog_rows):
+    """
+    One row of sync_run_history. last_updates are the source last_update values of the
+    changes we just applied, and the lag for each one is how long it took from that
+    change happening in the source to it being committed in the warehouse.
+    """
+    lags = [(applied_at - ts).total_seconds() for ts in last_updates if ts is not None]
+    return SyncRunHistory(
+        run_started=run_started,
+        table_name=table_name,
+        mode=mode,
+        applied_at=applied_at,
+        rows_applied=rows_applied,
+        watermark=watermark,
+        lag_p50_seconds=percentile(lags, 50),
+        lag_p95_seconds=percentile(lags, 95),
+        lag_max_seconds=max(lags) if lags else None,
+        backlog_rows=backlog_rows
+    )
+
+def upsert_dim_film(target_session, source_session, row):
+    upsert(target_session, DimFilm(**dim_film_row(source_session, row)))
+
+def upsert_dim_actor(target_session, row):
+    upsert(target_session, DimActor(**dim_actor_row(row)))
+
+def upsert_dim_category(target_session, row):
+    upsert(target_session, DimCategory(**dim_category_row(row)))
+
+def upsert_film_actor(target_session, row):
+    upsert(target_session, BridgeFilmActor(**film_actor_row(row)))
+
+def upsert_film_category(target_session, row):
+    upsert(target_session, BridgeFilmCategory(**film_category_row(row)))
+
+def upsert_rental(target_session, source_session, row):
+    upsert(target_session, FactRental(**fact_rental_row(source_session, row)))
+    if row.rental_date:
+        upsert(target_session, dim_date_from_date(row.rental_date))
+    if row.return_date:
+        upsert(target_session, dim_date_from_date(row.return_date))
+
+def upsert_payment(target_session, row):
+    upsert(target_session, FactPayment(**fact_payment_row(row)))
+    if row.payment_date:
+        upsert(target_session, dim_date_from_date(row.payment_date))
+
+def upsert_customer(target_session, source_session, row):
+    upsert(target_session, DimCustomer(**dim_customer_row(source_session, row)))
+
+def upsert_store(target_session, source_session, row):
+    upsert(target_session, DimStore(**dim_store_row(source_session, row)))
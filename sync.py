@@ -1,26 +1,41 @@
 import argparse
 import logging
 from datetime import datetime, timedelta
-from sqlalchemy import create_engine, select, func
+from sqlalchemy import create_engine, select, func, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import SQLAlchemyError
 
-from models import Film, Language, Actor, Category, FilmActor, FilmCategory, Rental, Payment, Inventory, Store, Customer
-from analytics import BaseAnalytics, DimFilm, FactRental, FactPayment, SyncState
+from models import Film, Actor, Category, FilmActor, FilmCategory, Rental, Payment, Inventory, Store, Customer
+from analytics import (
+    BaseAnalytics, DimDate, DimFilm, DimActor, DimCategory, DimStore, DimCustomer,
+    BridgeFilmActor, BridgeFilmCategory, FactRental, FactPayment, SyncState, SyncRunHistory
+)
 from helpers import *
+from snapshot import take_snapshot, open_snapshot
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("sync")
 
+def target_connect_args(target_url: str):
+    backend = make_url(target_url).get_backend_name()
+    if backend == "sqlite":
+        return {"check_same_thread": False}
+    return {}
+
 def make_sessions(source_url: str, target_url: str):
     """
     So basically we need to connect the two databases together somehow and that's
     sort of what this function is doing, it is establishing connections with both
     databases so we can transfer data between them.
+
+    The target can be SQLite or DuckDB (duckdb:///analytics.duckdb). check_same_thread is
+    a SQLite-only option so we only pass it when the target actually is SQLite.
+    source_url can be None when we are loading from a snapshot and never touch the source.
     """
-    source_engine = create_engine(source_url, pool_pre_ping=True)
-    target_engine = create_engine(target_url, connect_args={"check_same_thread": False})
-    SourceSession = sessionmaker(bind=source_engine)
+    source_engine = create_engine(source_url, pool_pre_ping=True) if source_url else None
+    target_engine = create_engine(target_url, connect_args=target_connect_args(target_url))
+    SourceSession = sessionmaker(bind=source_engine) if source_engine else None
     TargetSession = sessionmaker(bind=target_engine)
     return source_engine, target_engine, SourceSession, TargetSession
 
@@ -28,8 +43,20 @@ def init(target_engine):
     """
     This creates the analytics database defined in the analytics.py file.
     We need to do this to be able to transfer the data.
+
+    create_all skips tables that already exist, so if a warehouse was made before we added
+    a column to one of the models (like is_inferred on the dims) we add it here, otherwise
+    the next full-load fails with "no such column".
     """
     BaseAnalytics.metadata.create_all(bind=target_engine)
+    with target_engine.begin() as conn:
+        for table in BaseAnalytics.metadata.sorted_tables:
+            # reading the column names off an empty select works the same on SQLite and DuckDB
+            existing = set(conn.execute(text(f"SELECT * FROM {table.name} LIMIT 0")).keys())
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=target_engine.dialect)}"))
+                    logger.info("Added missing column %s.%s", table.name, column.name)
     logger.info("Analytics schema created.")
 
 def ensure_sync_state(target_session, table_names):
@@ -52,61 +79,66 @@ def ensure_sync_state(target_session, table_names):
             target_session.add(SyncState(table_name=t, last_synced=datetime(1970,1,1)))
     target_session.commit()
 
-def full_load(source_session, target_session):
+def full_load(source_session, target_session, watermarks=None):
+    """
+    Copies everything from the source into the warehouse. When we load from a snapshot,
+    watermarks holds the high-water marks the snapshot recorded, and those go into
+    SyncState so the next incremental only picks up what changed after the snapshot.
+    """
     logger.info("Starting full load")
+    run_started = datetime.now()
     try:
         with target_session.begin():
-            langs = source_session.scalars(select(Language)).all()
-            lang_map = {l.language_id: l.name for l in langs}
+            dim_keys = DimKeyCache(target_session)
 
             films = source_session.scalars(select(Film)).all()
-            for f in films:
-                upsert_dim_film(target_session, source_session, row=f)
+            film_rows = [dim_film_row(source_session, f) for f in films]
+            bulk_upsert(target_session, DimFilm, film_rows)
+            dim_keys.add(DimFilm, *(r["film_key"] for r in film_rows))
 
             actors = source_session.scalars(select(Actor)).all()
-            for a in actors:
-                upsert_dim_actor(target_session, row=a)
+            bulk_upsert(target_session, DimActor, [dim_actor_row(a) for a in actors])
 
             cats = source_session.scalars(select(Category)).all()
-            for c in cats:
-                upsert_dim_category(target_session, row=c)
+            bulk_upsert(target_session, DimCategory, [dim_category_row(c) for c in cats])
 
             fas = source_session.scalars(select(FilmActor)).all()
-            for fa in fas:
-                upsert_film_actor(target_session, row=fa)
+            bulk_upsert(target_session, BridgeFilmActor, [film_actor_row(fa) for fa in fas])
 
             fcs = source_session.scalars(select(FilmCategory)).all()
-            for fc in fcs:
-                upsert_film_category(target_session, row=fc)
+            bulk_upsert(target_session, BridgeFilmCategory, [film_category_row(fc) for fc in fcs])
 
             stores = source_session.scalars(select(Store)).all()
-            for s in stores:
-                upsert_store(target_session, source_session, row=s)
+            store_rows = [dim_store_row(source_session, s) for s in stores]
+            bulk_upsert(target_session, DimStore, store_rows)
+            dim_keys.add(DimStore, *(r["store_key"] for r in store_rows))
 
             customers = source_session.scalars(select(Customer)).all()
-            for c in customers:
-                upsert_customer(target_session, source_session, row=c)
+            customer_rows = [dim_customer_row(source_session, c) for c in customers]
+            bulk_upsert(target_session, DimCustomer, customer_rows)
+            dim_keys.add(DimCustomer, *(r["customer_key"] for r in customer_rows))
 
             rentals = source_session.scalars(select(Rental)).all()
-            for r in rentals:
-                upsert_rental(target_session, source_session, row=r)
-
             payments = source_session.scalars(select(Payment)).all()
-            for p in payments:
-                upsert_payment(target_session, row=p)
-
-            sync_timestamps = {
-                "film": get_last_update(source_session, Film),
-                "actor": get_last_update(source_session, Actor),
-                "category": get_last_update(source_session, Category),
-                "film_actor": get_last_update(source_session, FilmActor),
-                "film_category": get_last_update(source_session, FilmCategory),
-                "inventory": get_last_update(source_session, Inventory),
-                "rental": get_last_update(source_session, Rental),
-                "payment": get_last_update(source_session, Payment),
-                "customer": get_last_update(source_session, Customer),
-                "store": get_last_update(source_session, Store)
-            }
+
+            # the dates have to be in dim_date before the facts point at them
+            dates = [r.rental_date for r in rentals] + [r.return_date for r in rentals] + [p.payment_date for p in payments]
+            bulk_upsert(target_session, DimDate, dim_date_rows(dates))
+
+            rental_rows = [fact_rental_row(source_session, r) for r in rentals]
+            payment_rows = [fact_payment_row(p) for p in payments]
+            inferred = add_inferred_members(target_session, dim_keys, rental_rows + payment_rows)
+            if inferred:
+                logger.info("Added %d inferred dimension rows for late-arriving facts", inferred)
+            bulk_upsert(target_session, FactRental, rental_rows)
+            bulk_upsert(target_session, FactPayment, payment_rows)
+
+            # the snapshot manifest already recorded the high-water marks, so only ask the
+            # source for max(last_update) when we are loading from the live database
+            if watermarks:
+                sync_timestamps = {t: watermarks[t] for t, _, _ in SYNC_PLAN}
+            else:
+                sync_timestamps = {t: get_last_update(source_session, model) for t, model, _ in SYNC_PLAN}
 
             for table_name, max_ts in sync_timestamps.items():
                 existing = target_session.get(SyncState, table_name)
@@ -118,26 +150,75 @@ def full_load(source_session, target_session):
         target_session.commit()
         logger.info("Full load completed and committed.")
 
+        # a full load copies old history too, so there is no meaningful lag to record here,
+        # just how many rows went in, where the watermark ended up and what is still above it.
+        # applied_at is taken after the commit since that is when the rows became visible
+        rows_loaded = {
+            "film": len(films), "actor": len(actors), "category": len(cats), "film_actor": len(fas),
+            "film_category": len(fcs), "inventory": 0, "rental": len(rentals), "payment": len(payments),
+            "customer": len(customers), "store": len(stores)
+        }
+        # when we load from a snapshot, source_session is the snapshot itself, so there is no way
+        # to know what is waiting in the live source and we leave the backlog empty
+        applied_at = datetime.now()
+        for table_name, model, ts_field in SYNC_PLAN:
+            watermark = sync_timestamps[table_name]
+            backlog = None if watermarks else source_backlog(source_session, model, ts_field, watermark)
+            target_session.add(sync_run_row(run_started, table_name, "full-load", applied_at, rows_loaded[table_name],
+                                            watermark, [], backlog))
+        target_session.commit()
+
     except SQLAlchemyError as e:
         target_session.rollback()
         logger.exception("Full load failed; transaction rolled back.")
         raise
 
+SYNC_PLAN = [
+    ("film", Film, "last_update"),
+    ("actor", Actor, "last_update"),
+    ("category", Category, "last_update"),
+    ("film_actor", FilmActor, "last_update"),
+    ("film_category", FilmCategory, "last_update"),
+    ("inventory", Inventory, "last_update"),
+    ("rental", Rental, "last_update"),
+    ("payment", Payment, "last_update"),
+    ("customer", Customer, "last_update"),
+    ("store", Store, "last_update"),
+]
+
+def source_backlog(source_session, model, ts_field, watermark):
+    # how many source rows changed after the watermark and are still waiting to be synced
+    return source_session.scalar(select(func.count()).select_from(model).where(getattr(model, ts_field) > watermark))
+
+def target_batch(source_session, model, rows, fact_rows):
+    # which analytics table a source table lands in and the rows for it, so DuckDB can take
+    # the whole table in one bulk_upsert instead of a merge per row. inventory has no table
+    # of its own, it only gets looked up when building rentals
+    if model is Film:
+        return DimFilm, [dim_film_row(source_session, r) for r in rows]
+    if model is Actor:
+        return DimActor, [dim_actor_row(r) for r in rows]
+    if model is Category:
+        return DimCategory, [dim_category_row(r) for r in rows]
+    if model is FilmActor:
+        return BridgeFilmActor, [film_actor_row(r) for r in rows]
+    if model is FilmCategory:
+        return BridgeFilmCategory, [film_category_row(r) for r in rows]
+    if model is Rental:
+        return FactRental, fact_rows
+    if model is Payment:
+        return FactPayment, fact_rows
+    if model is Customer:
+        return DimCustomer, [dim_customer_row(source_session, r) for r in rows]
+    if model is Store:
+        return DimStore, [dim_store_row(source_session, r) for r in rows]
+    return None, []
+
 def incremental(source_session, target_session):
     logger.info("Starting incremental sync")
-    sync_plan = [
-        ("film", Film, "last_update"),
-        ("actor", Actor, "last_update"),
-        ("category", Category, "last_update"),
-        ("film_actor", FilmActor, "last_update"),
-        ("film_category", FilmCategory, "last_update"),
-        ("inventory", Inventory, "last_update"),
-        ("rental", Rental, "last_update"),
-        ("payment", Payment, "last_update"),
-        ("customer", Customer, "last_update"),
-        ("store", Store, "last_update"),
-    ]
-    for table_name, model, ts_field in sync_plan:
+    run_started = datetime.now()
+    dim_keys = DimKeyCache(target_session)
+    for table_name, model, ts_field in SYNC_PLAN:
         state = target_session.get(SyncState, table_name)
         last_synced = state.last_synced if state else datetime(1970,1,1)
         logger.info("Checking table %s (since %s)", table_name, last_synced)
@@ -148,41 +229,85 @@ def incremental(source_session, target_session):
             logger.info("No changes for %s", table_name)
             continue
 
+        # every table gets its own transaction, so a table that fails only rolls back itself and
+        # the rows of the tables before it are already visible in the warehouse
         try:
             new_last = max(getattr(r, ts_field) for r in rows if getattr(r, ts_field) is not None)
-            
-            with target_session.begin_nested():
-                for r in rows:
-                    if isinstance(r, Film):
-                        upsert_dim_film(target_session, source_session, row=r)
-                    elif isinstance(r, Actor):
-                        upsert_dim_actor(target_session, row=r)
-                    elif isinstance(r, Category):
-                        upsert_dim_category(target_session, row=r)
-                    elif isinstance(r, FilmActor):
-                        upsert_film_actor(target_session, r)
-                    elif isinstance(r, FilmCategory):
-                        upsert_film_category(target_session, row=r)
-                    elif isinstance(r, Inventory):
-                        pass
-                    elif isinstance(r, Rental):
-                        upsert_rental(target_session, source_session, row=r)
-                    elif isinstance(r, Payment):
-                        upsert_payment(target_session, row=r)
-                    elif isinstance(r, Customer):
-                        upsert_customer(target_session, source_session, row=r)
-                    elif isinstance(r, Store):
-                        upsert_store(target_session, source_session, row=r)
-
-                st = target_session.get(SyncState, table_name)
-                if st:
-                    st.last_synced = new_last
-                else:
-                    target_session.add(SyncState(table_name=table_name, last_synced=new_last))
+
+            if model is Rental:
+                fact_rows = [fact_rental_row(source_session, r) for r in rows]
+                dates = [r.rental_date for r in rows] + [r.return_date for r in rows]
+            elif model is Payment:
+                fact_rows = [fact_payment_row(r) for r in rows]
+                dates = [r.payment_date for r in rows]
+            else:
+                fact_rows = []
+                dates = []
+            # same as full_load, the dates and any inferred dimension rows have to be in before
+            # the facts, otherwise enforced foreign keys reject the whole table
+            bulk_upsert(target_session, DimDate, dim_date_rows(dates))
+            inferred = add_inferred_members(target_session, dim_keys, fact_rows)
+            if inferred:
+                logger.info("Added %d inferred dimension rows for %s", inferred, table_name)
+
+            if is_columnar(target_session):
+                target_model, batch = target_batch(source_session, model, rows, fact_rows)
+                if target_model is not None:
+                    bulk_upsert(target_session, target_model, batch)
+                    if target_model in dim_keys.keys:
+                        pk = target_model.__table__.primary_key.columns[0].name
+                        dim_keys.add(target_model, *(b[pk] for b in batch))
+                rows_to_merge = []
+            else:
+                rows_to_merge = rows
+
+            for r in rows_to_merge:
+                if isinstance(r, Film):
+                    upsert_dim_film(target_session, source_session, row=r)
+                    dim_keys.add(DimFilm, get_key_from_id(r.film_id))
+                elif isinstance(r, Actor):
+                    upsert_dim_actor(target_session, row=r)
+                elif isinstance(r, Category):
+                    upsert_dim_category(target_session, row=r)
+                elif isinstance(r, FilmActor):
+                    upsert_film_actor(target_session, r)
+                elif isinstance(r, FilmCategory):
+                    upsert_film_category(target_session, row=r)
+                elif isinstance(r, Inventory):
+                    pass
+                elif isinstance(r, Rental):
+                    upsert_rental(target_session, source_session, row=r)
+                elif isinstance(r, Payment):
+                    upsert_payment(target_session, row=r)
+                elif isinstance(r, Customer):
+                    upsert_customer(target_session, source_session, row=r)
+                    dim_keys.add(DimCustomer, get_key_from_id(r.customer_id))
+                elif isinstance(r, Store):
+                    upsert_store(target_session, source_session, row=r)
+                    dim_keys.add(DimStore, get_key_from_id(r.store_id))
+
+            st = target_session.get(SyncState, table_name)
+            if st:
+                st.last_synced = new_last
+            else:
+                target_session.add(SyncState(table_name=table_name, last_synced=new_last))
+
+            target_session.commit()
+
+            # we pick up rows with last_update >= the watermark, so the ones sitting right on it
+            # were already applied last time and would just make the lag look worse every run.
+            # applied_at is taken after the commit since that is when the rows became visible
+            changes = [getattr(r, ts_field) for r in rows if getattr(r, ts_field) is not None and getattr(r, ts_field) > last_synced]
+            target_session.add(sync_run_row(run_started, table_name, "incremental", datetime.now(), len(changes), new_last,
+                                            changes, source_backlog(source_session, model, ts_field, new_last)))
+            target_session.commit()
 
             logger.info("Synced %d rows for %s (new_last=%s)", len(rows), table_name, new_last)
 
         except SQLAlchemyError:
+            target_session.rollback()
+            # anything this table added to the key cache got rolled back with it
+            dim_keys.warm()
             logger.exception("Error syncing table %s; skipping and rolling back that table.", table_name)
 
 def validate(source_session, target_session, days=30, threshold_pct=1.0):
@@ -226,28 +351,103 @@ def validate(source_session, target_session, days=30, threshold_pct=1.0):
     logger.info("Validation passed.")
     return True, []
 
+def status(source_session, target_session, max_lag_seconds=None):
+    """
+    Shows how fresh the warehouse is for each table: when we last applied anything, the
+    lag histogram from the last run that actually had new changes, and how many source
+    rows are sitting above the watermark right now waiting for the next incremental.
+    The current lag is how long the oldest of those waiting rows has been waiting, so it
+    keeps growing if incremental stops running or keeps failing a table.
+    If max_lag_seconds is given, any table whose p95 lag or current lag is over it counts
+    as a problem, same idea as validate so it can be used for alerting.
+    """
+    logger.info("Sync status")
+    now = datetime.now()
+    report = []
+    for table_name, model, ts_field in SYNC_PLAN:
+        state = target_session.get(SyncState, table_name)
+        last_synced = state.last_synced if state else datetime(1970,1,1)
+        backlog = source_backlog(source_session, model, ts_field, last_synced)
+        field = getattr(model, ts_field)
+        oldest_pending = source_session.scalar(select(func.min(field)).where(field > last_synced))
+        current_lag = (now - oldest_pending).total_seconds() if oldest_pending else 0.0
+        last_run = target_session.scalars(select(SyncRunHistory)
+                                          .where(SyncRunHistory.table_name == table_name)
+                                          .order_by(SyncRunHistory.run_started.desc()).limit(1)).first()
+        lag_run = target_session.scalars(select(SyncRunHistory)
+                                         .where(SyncRunHistory.table_name == table_name, SyncRunHistory.lag_p95_seconds.is_not(None))
+                                         .order_by(SyncRunHistory.run_started.desc()).limit(1)).first()
+        report.append({
+            "table_name": table_name,
+            "watermark": last_synced,
+            "last_applied": last_run.applied_at if last_run else None,
+            "lag_p50_seconds": lag_run.lag_p50_seconds if lag_run else None,
+            "lag_p95_seconds": lag_run.lag_p95_seconds if lag_run else None,
+            "lag_max_seconds": lag_run.lag_max_seconds if lag_run else None,
+            "backlog_rows": backlog,
+            "current_lag_seconds": current_lag
+        })
+        logger.info("%s - watermark: %s, last applied: %s, lag p50/p95/max (s): %s/%s/%s, backlog: %s, current lag: %.1fs",
+                    table_name, last_synced, report[-1]["last_applied"], report[-1]["lag_p50_seconds"],
+                    report[-1]["lag_p95_seconds"], report[-1]["lag_max_seconds"], backlog, current_lag)
+
+    lagging = [r for r in report if r["lag_p95_seconds"] is not None]
+    if lagging:
+        worst = max(lagging, key=lambda r: r["lag_p95_seconds"])
+        logger.info("Slowest table: %s (p95 lag %.1fs)", worst["table_name"], worst["lag_p95_seconds"])
+
+    problems = []
+    if max_lag_seconds is not None:
+        for r in lagging:
+            if r["lag_p95_seconds"] > max_lag_seconds:
+                problems.append(f"{r['table_name']} p95 lag {r['lag_p95_seconds']:.1f}s is over {max_lag_seconds}s")
+        for r in report:
+            if r["current_lag_seconds"] > max_lag_seconds:
+                problems.append(f"{r['table_name']} has {r['backlog_rows']} rows waiting for {r['current_lag_seconds']:.1f}s, over {max_lag_seconds}s")
+
+    if problems:
+        logger.warning("Freshness problems found:\n%s", "\n".join(problems))
+        return False, report
+    return True, report
+
 def parse_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--source", required=True)
+    parser.add_argument("--source")
     parser.add_argument("--target", default="sqlite:///analytics.db")
-    parser.add_argument("command", choices=["init", "full-load", "incremental", "validate"])
-    return parser.parse_args()
+    parser.add_argument("--snapshot-dir", default="snapshot")
+    parser.add_argument("--from-snapshot", metavar="DIR", help="full-load from a snapshot directory instead of the source")
+    parser.add_argument("--max-lag", type=float, help="status fails if any table's p95 or current lag is over this many seconds")
+    parser.add_argument("command", choices=["init", "snapshot", "full-load", "incremental", "validate", "status"])
+    args = parser.parse_args()
+    if not args.source and not (args.command == "full-load" and args.from_snapshot):
+        parser.error("--source is required unless running full-load --from-snapshot")
+    return args
 
 if __name__ == "__main__":
     args = parse_args()
     source_engine, target_engine, SourceSession, TargetSession = make_sessions(args.source, args.target)
-    source_session = SourceSession()
+    source_session = SourceSession() if SourceSession else None
     target_session = TargetSession()
 
     if args.command == "init":
         init(target_engine)
+    elif args.command == "snapshot":
+        take_snapshot(source_session, args.snapshot_dir)
     elif args.command == "full-load":
-        full_load(source_session, target_session)
+        if args.from_snapshot:
+            snapshot_session, watermarks = open_snapshot(args.from_snapshot)
+            full_load(snapshot_session, target_session, watermarks=watermarks)
+        else:
+            full_load(source_session, target_session)
     elif args.command == "incremental":
         incremental(source_session, target_session)
     elif args.command == "validate":
         ok, problems = validate(source_session, target_session)
         if not ok:
             raise SystemExit(2)
+    elif args.command == "status":
+        ok, report = status(source_session, target_session, max_lag_seconds=args.max_lag)
+        if not ok:
+            raise SystemExit(2)
     else:
         print("Unknown command")
\ No newline at end of file
@@ -1,11 +1,14 @@
 import pytest
-from datetime import datetime
-from sqlalchemy import create_engine
+from datetime import datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import create_engine, event, select, func
 from sqlalchemy.orm import sessionmaker
 
-from models import BaseSource, Film, Language
-from analytics import BaseAnalytics, DimFilm, SyncState
+from models import BaseSource, Film, Language, Inventory, Rental, Payment, Customer, Store
+from analytics import BaseAnalytics, DimDate, DimFilm, DimCustomer, FactRental, FactPayment, SyncState, SyncRunHistory
+import helpers
 import sync
+import snapshot
 
 @pytest.fixture
 def source_engine_and_session():
@@ -102,4 +105,187 @@ def test_validate(source_engine_and_session, tmp_path):
 
     ok, problems = sync.validate(source_sess, target_sess)
     assert ok is True
-    target_sess.close()
\ No newline at end of file
+    target_sess.close()
+
+def test_duckdb_target(source_engine_and_session, tmp_path, monkeypatch):
+    pytest.importorskip("duckdb_engine")
+    source_engine, source_sess = source_engine_and_session
+    now = datetime.now()
+    source_sess.add(Store(store_id=1, last_update=now))
+    source_sess.add(Customer(customer_id=1, store_id=1, first_name="Test", last_name="Customer", active=1, last_update=now))
+    source_sess.add(Inventory(inventory_id=1, film_id=1, store_id=1, last_update=now))
+    source_sess.add(Rental(rental_id=1, rental_date=now, inventory_id=1, customer_id=1, staff_id=1, last_update=now))
+    source_sess.add(Payment(payment_id=1, customer_id=1, staff_id=1, rental_id=1, amount=Decimal("4.99"),
+                            payment_date=now, last_update=now))
+    source_sess.commit()
+
+    db_url = f"duckdb:///{tmp_path/'analytics.duckdb'}"
+    engine = create_engine(db_url, connect_args=sync.target_connect_args(db_url))
+    TargetSession = sessionmaker(bind=engine)
+    target_sess = TargetSession()
+    sync.init(engine)
+    sync.full_load(source_sess, target_sess)
+    assert target_sess.query(FactRental).count() == 1
+    assert target_sess.scalar(select(func.sum(FactPayment.amount))) == Decimal("4.99")
+    assert target_sess.get(DimDate, int(now.strftime("%Y%m%d"))) is not None
+
+    film = source_sess.get(Film, 1)
+    film.title = "Updated Title"
+    film.last_update = datetime.now()
+    rental = source_sess.get(Rental, 1)
+    rental.return_date = now + timedelta(days=3)
+    rental.last_update = datetime.now()
+    payment = source_sess.get(Payment, 1)
+    payment.amount = Decimal("7.50")
+    payment.last_update = datetime.now()
+    source_sess.commit()
+
+    # on DuckDB incremental should go through bulk_upsert, never a merge per row
+    def no_merge(session, obj):
+        raise AssertionError("per-row merge on DuckDB")
+    monkeypatch.setattr(helpers, "upsert", no_merge)
+    sync.incremental(source_sess, target_sess)
+    f1 = target_sess.query(DimFilm).filter_by(film_id=1).one()
+    assert f1.title == "Updated Title"
+    assert target_sess.query(FactRental).count() == 1
+    assert target_sess.query(FactRental).filter_by(rental_id=1).one().rental_duration_days == 3
+    assert target_sess.query(FactPayment).count() == 1
+    assert target_sess.scalar(select(func.sum(FactPayment.amount))) == Decimal("7.50")
+    ok, problems = sync.validate(source_sess, target_sess)
+    assert ok is True
+    target_sess.close()
+
+def test_full_load_from_snapshot(source_engine_and_session, tmp_path):
+    pytest.importorskip("pyarrow")
+    source_engine, source_sess = source_engine_and_session
+    snap_dir = tmp_path/"snapshot"
+    watermarks = snapshot.take_snapshot(source_sess, snap_dir)
+
+    film = source_sess.get(Film, 1)
+    film.title = "Changed After Snapshot"
+    film.last_update = datetime.utcnow()
+    source_sess.commit()
+
+    db_url = f"sqlite:///{tmp_path/'analytics_snapshot.db'}"
+    engine = create_engine(db_url, connect_args={"check_same_thread": False})
+    TargetSession = sessionmaker(bind=engine)
+    target_sess = TargetSession()
+    sync.init(engine)
+    snap_sess, snap_watermarks = snapshot.open_snapshot(snap_dir)
+    sync.full_load(snap_sess, target_sess, watermarks=snap_watermarks)
+    f1 = target_sess.query(DimFilm).filter_by(film_id=1).one()
+    assert f1.title == "Test Movie"
+    assert target_sess.get(SyncState, "film").last_synced.isoformat() == watermarks["film"]
+    assert target_sess.query(SyncRunHistory).filter_by(table_name="film", mode="full-load").one().backlog_rows is None
+
+    sync.incremental(source_sess, target_sess)
+    f1 = target_sess.query(DimFilm).filter_by(film_id=1).one()
+    assert f1.title == "Changed After Snapshot"
+    target_sess.close()
+
+def test_late_arriving_fact_gets_inferred_dimension(source_engine_and_session, tmp_path):
+    source_engine, source_sess = source_engine_and_session
+    source_sess.add(Inventory(inventory_id=1, film_id=1, store_id=1, last_update=datetime.utcnow()))
+    source_sess.add(Rental(rental_id=1, rental_date=datetime(2025,1,1), inventory_id=1, customer_id=7,
+                           return_date=datetime(2025,1,3), staff_id=1, last_update=datetime.utcnow()))
+    source_sess.commit()
+
+    db_url = f"sqlite:///{tmp_path/'analytics_inferred.db'}"
+    engine = create_engine(db_url, connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", lambda conn, _: conn.execute("PRAGMA foreign_keys=ON"))
+    TargetSession = sessionmaker(bind=engine)
+    target_sess = TargetSession()
+    sync.init(engine)
+    sync.full_load(source_sess, target_sess)
+    assert target_sess.query(FactRental).filter_by(rental_id=1).one().customer_key == 701
+    c = target_sess.get(DimCustomer, 701)
+    assert c.is_inferred is True and c.customer_id == 7 and c.first_name is None
+
+    source_sess.add(Customer(customer_id=7, first_name="Late", last_name="Arrival", active=1, last_update=datetime.utcnow()))
+    source_sess.commit()
+    sync.incremental(source_sess, target_sess)
+    c = target_sess.get(DimCustomer, 701)
+    assert c.is_inferred is False and c.first_name == "Late"
+    target_sess.close()
+
+def test_incremental_facts_with_foreign_keys(source_engine_and_session, tmp_path):
+    source_engine, source_sess = source_engine_and_session
+    db_url = f"sqlite:///{tmp_path/'analytics_inc_fk.db'}"
+    engine = create_engine(db_url, connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", lambda conn, _: conn.execute("PRAGMA foreign_keys=ON"))
+    TargetSession = sessionmaker(bind=engine)
+    target_sess = TargetSession()
+    sync.init(engine)
+    sync.full_load(source_sess, target_sess)
+
+    now = datetime.now()
+    source_sess.add(Inventory(inventory_id=1, film_id=1, store_id=1, last_update=now))
+    source_sess.add(Rental(rental_id=1, rental_date=now, inventory_id=1, customer_id=7, staff_id=1, last_update=now))
+    source_sess.add(Payment(payment_id=1, customer_id=7, staff_id=1, rental_id=1, amount=Decimal("2.99"),
+                            payment_date=now, last_update=now))
+    source_sess.commit()
+
+    sync.incremental(source_sess, target_sess)
+    assert target_sess.query(FactRental).count() == 1
+    assert target_sess.query(FactPayment).count() == 1
+    assert target_sess.get(DimDate, int(now.strftime("%Y%m%d"))) is not None
+    assert target_sess.get(DimCustomer, 701).is_inferred is True
+    target_sess.close()
+
+def test_status(source_engine_and_session, tmp_path):
+    source_engine, source_sess = source_engine_and_session
+    db_url = f"sqlite:///{tmp_path/'analytics_status.db'}"
+    engine = create_engine(db_url, connect_args={"check_same_thread": False})
+    TargetSession = sessionmaker(bind=engine)
+    target_sess = TargetSession()
+    sync.init(engine)
+    sync.full_load(source_sess, target_sess)
+
+    source_sess.add(Film(film_id=2, title="New Movie", language_id=1, rating="G", length=90,
+                         release_year=2021, last_update=datetime.now()))
+    source_sess.commit()
+    ok, report = sync.status(source_sess, target_sess)
+    film = next(r for r in report if r["table_name"] == "film")
+    assert film["backlog_rows"] == 1 and film["lag_p95_seconds"] is None
+
+    sync.incremental(source_sess, target_sess)
+    ok, report = sync.status(source_sess, target_sess, max_lag_seconds=3600)
+    film = next(r for r in report if r["table_name"] == "film")
+    assert ok is True
+    assert film["backlog_rows"] == 0 and film["lag_max_seconds"] >= 0
+    run = target_sess.query(SyncRunHistory).filter_by(table_name="film", mode="incremental").one()
+    assert run.rows_applied == 1 and run.backlog_rows == 0
+
+    source_sess.add(Film(film_id=3, title="Another Movie", language_id=1, rating="G", length=90,
+                         release_year=2022, last_update=datetime(2000,1,1)))
+    source_sess.commit()
+    sync.incremental(source_sess, target_sess)
+    runs = target_sess.query(SyncRunHistory).filter_by(table_name="film", mode="incremental").order_by(SyncRunHistory.run_started).all()
+    assert runs[-1].rows_applied == 0 and runs[-1].backlog_rows == 0
+
+    # incremental stopped three hours ago and a change has been waiting for two, the last
+    # p95 still looks fine but the current lag has to trip the alert
+    target_sess.get(SyncState, "film").last_synced = datetime.now() - timedelta(hours=3)
+    target_sess.commit()
+    source_sess.add(Film(film_id=4, title="Stuck Movie", language_id=1, rating="G", length=90,
+                         release_year=2022, last_update=datetime.now() - timedelta(hours=2)))
+    source_sess.commit()
+    ok, report = sync.status(source_sess, target_sess, max_lag_seconds=3600)
+    film = next(r for r in report if r["table_name"] == "film")
+    assert ok is False
+    assert film["lag_p95_seconds"] < 3600 and film["current_lag_seconds"] >= 7200
+    target_sess.close()
+
+def test_init_adds_missing_columns(tmp_path):
+    db_url = f"sqlite:///{tmp_path/'analytics_old.db'}"
+    engine = create_engine(db_url)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE dim_film (film_key INTEGER PRIMARY KEY, film_id INTEGER, title VARCHAR, "
+                             "rating VARCHAR(10), length INTEGER, language VARCHAR(50), release_year INTEGER, last_update DATETIME)")
+    sync.init(engine)
+    Session = sessionmaker(bind=engine)
+    s = Session()
+    s.add(DimFilm(film_key=101, film_id=1, title="Old Warehouse", is_inferred=False))
+    s.commit()
+    assert s.get(DimFilm, 101).is_inferred is False
+    s.close()